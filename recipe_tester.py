@@ -28,6 +28,9 @@ import json
 import argparse
 import glob
 import os
+import time
+import copy
+import hashlib
 
 SUPPORTED_RECIPE_TYPES = ['download', 'pkg', 'munki']
 TESTS_FOLDER = './tests'
@@ -47,31 +50,46 @@ class Recipe(dict):
             print e
 
     def set_recipe_type(self):
-        # Set recipe type based on extension
-        recipe_type = ''
-        try:
-            recipe_type = self.recipe_file.split('.')[-2]
-        except IndexError as e:
-            pass
-        if recipe_type in SUPPORTED_RECIPE_TYPES:
-            self.recipe_type = recipe_type
-        else:
-            self.recipe_type = 'unknown'
+        self.recipe_type = recipe_type_from_file(self.recipe_file)
+
+
+def recipe_type_from_file(recipe_file):
+    '''Returns the recipe type based on extension'''
+    recipe_type = ''
+    try:
+        recipe_type = recipe_file.split('.')[-2]
+    except IndexError as e:
+        pass
+    if recipe_type in SUPPORTED_RECIPE_TYPES:
+        return recipe_type
+    return 'unknown'
 
 
 class RecipeTester(object):
     ''' Generic recipe testing class '''
-    def __init__(self, recipe_file, test_suite):
-        self.test_suite = test_suite
+    def __init__(self, recipe_file, test_suites):
+        self.recipe_file = recipe_file
+        self.test_suite = {}
         self.recipe = {}
         self.results = []
         self.stop_running_tests = False
         try:
             self.recipe = Recipe(recipe_file)
             self.recipe_type = self.recipe.recipe_type
+            self.test_suite = test_suites.get(self.recipe_type, {})
         except Exception as e:
             print 'Unable to load recipe plist from file.'
 
+    def copy_for_file(self, recipe_file):
+        '''Returns a tester for an identical recipe at another path,
+        sharing this tester's recipe contents and results'''
+        rt = copy.copy(self)
+        rt.recipe_file = recipe_file
+        if isinstance(self.recipe, Recipe):
+            rt.recipe = copy.copy(self.recipe)
+            rt.recipe.recipe_file = recipe_file
+        return rt
+
     def test_recipe_is_loaded(self, severity):
         '''Tests if recipe can be loaded successfully.'''
         fail_reason = 'The recipe could not be loaded'
@@ -186,7 +204,7 @@ class RecipeTester(object):
             return this_result['result']
 
     def run_tests(self):
-        if self.recipe.recipe_type == self.test_suite['test_suite']:
+        if self.recipe.recipe_type == self.test_suite.get('test_suite'):
             for test in self.test_suite['tests']:
                 if not self.stop_running_tests:
                     if test['test_type'] == 'recipe_is_loaded':
@@ -219,7 +237,27 @@ class RecipeTester(object):
                     else:
                         print 'Invalid test_type found: %s' % test['test_type']
 
-    def output_test_results(self, method):
+    def recipe_identifier(self):
+        '''Returns the recipe Identifier, or the file path if it has none'''
+        if self.recipe and 'Identifier' in self.recipe:
+            return self.recipe['Identifier']
+        return decode_utf8(self.recipe_file)
+
+    def fingerprint(self, result):
+        '''Returns the baseline fingerprint tuple for a failed result'''
+        return (self.recipe_identifier(),
+                result['test_type'],
+                result.get('keypath', ''),
+                result['fail_severity'])
+
+    def failure_fingerprints(self):
+        '''Returns the set of fingerprints for all failed results'''
+        return set(self.fingerprint(result) for result in self.results
+                   if result.get('result') == False)
+
+    def output_test_results(self, method, baseline=None):
+        if baseline is not None:
+            return self.output_new_failures(method, baseline)
         if method == 'console':
             results = 'Testing %s...\n' % self.recipe.recipe_file
             fails = 0
@@ -256,15 +294,266 @@ class RecipeTester(object):
                 separators=(',', ': ')
                 )
 
+    def output_new_failures(self, method, baseline):
+        '''Outputs only the failures whose fingerprint is not in baseline,
+        or None if there are none'''
+        new_results = [result for result in self.results
+                       if result.get('result') == False
+                       and self.fingerprint(result) not in baseline]
+        if not new_results:
+            return None
+        if method == 'console':
+            results = 'Testing %s...\n' % self.recipe_file
+            for result in new_results:
+                if result['fail_severity'] == 2:
+                    results += 'New failure in test \'%s\'! Reason: ' \
+                        '\'%s\'\n' % (result['test_type'],
+                                       result['fail_reason'])
+                elif result['fail_severity'] == 1:
+                    results += 'New warning in test \'%s\': \'%s\'\n' % (
+                        result['test_type'],
+                        result['fail_reason'])
+            results += '%i new failures or warnings since baseline\n' % (
+                len(new_results))
+            results += 72*'-'
+            return results
+
+        if method == 'json':
+            return json.dumps(
+                {
+                    'recipe': self.recipe_file,
+                    'identifier': self.recipe_identifier(),
+                    'new_failures': new_results
+                },
+                sort_keys=True,
+                indent=4,
+                separators=(',', ': ')
+                )
+
+def encode_utf8(value):
+    '''Returns value as a UTF-8 byte string'''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def decode_utf8(value):
+    '''Returns a UTF-8 byte string as unicode'''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def load_baseline(baseline_file):
+    '''Loads failure fingerprints from a baseline file, returning a dict
+    of fingerprint to the set of recipe paths that produced it.
+    Each line is tab separated and UTF-8 encoded: identifier, test_type,
+    keypath, severity, recipe path'''
+    baseline = {}
+    with open(baseline_file, 'r') as infile:
+        for line in infile:
+            fields = line.rstrip('\n').decode('utf-8').split('\t')
+            if len(fields) == 5:
+                fingerprint = (
+                    fields[0], fields[1], fields[2], int(fields[3]))
+                baseline.setdefault(fingerprint, set()).add(fields[4])
+    return baseline
+
+def write_baseline(baseline_file, fingerprints):
+    '''Writes a dict of fingerprint to recipe paths to a baseline file'''
+    with open(baseline_file, 'w') as outfile:
+        for fingerprint in sorted(fingerprints):
+            for path in sorted(fingerprints[fingerprint]):
+                outfile.write('%s\t%s\t%s\t%i\t%s\n' % (
+                    encode_utf8(fingerprint[0]),
+                    encode_utf8(fingerprint[1]),
+                    encode_utf8(fingerprint[2]),
+                    fingerprint[3],
+                    encode_utf8(path)))
+
+def resolved_failures(baseline, fingerprints, tested_paths):
+    '''Returns the baseline fingerprints that no longer fail. A fingerprint
+    only counts as resolved once every path that produced it was tested'''
+    return set(fingerprint for fingerprint, paths in baseline.iteritems()
+               if fingerprint not in fingerprints
+               and paths <= tested_paths)
+
+def merge_baseline(baseline, fingerprints, tested_paths):
+    '''Returns the fingerprints from this run, plus baseline entries for
+    recipe paths that were not tested in this run'''
+    merged = {}
+    for fingerprint, paths in baseline.iteritems():
+        untested_paths = paths - tested_paths
+        if untested_paths:
+            merged[fingerprint] = untested_paths
+    for fingerprint, paths in fingerprints.iteritems():
+        merged.setdefault(fingerprint, set()).update(paths)
+    return merged
+
+def output_resolved_failures(method, resolved):
+    '''Outputs baseline fingerprints that no longer fail'''
+    if method == 'console':
+        results = ''
+        for fingerprint in sorted(resolved):
+            results += 'Resolved in %s: test \'%s\' %s\n' % (
+                fingerprint[0], fingerprint[1], fingerprint[2])
+        results += '%i failures or warnings resolved since baseline' % (
+            len(resolved))
+        return encode_utf8(results)
+
+    if method == 'json':
+        return json.dumps(
+            {
+                'resolved_failures': [
+                    dict(zip(('identifier', 'test_type', 'keypath',
+                              'fail_severity'), fingerprint))
+                    for fingerprint in sorted(resolved)]
+            },
+            sort_keys=True,
+            indent=4,
+            separators=(',', ': ')
+            )
+
+class RunMetrics(object):
+    ''' Aggregates failure counts and timings across a run '''
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.recipes = 0
+        self.failures = {}
+        self.phase_seconds = {'load': 0.0, 'test': 0.0, 'emit': 0.0}
+
+    def add_phase_time(self, phase, seconds):
+        self.phase_seconds[phase] += seconds
+
+    def add_results(self, results):
+        '''Counts failed results by (test_type, keypath, severity)'''
+        self.recipes += 1
+        for result in results:
+            if result.get('result') == False:
+                key = (result['test_type'],
+                       result.get('keypath', ''),
+                       result['fail_severity'])
+                self.failures[key] = self.failures.get(key, 0) + 1
+
+    def finish(self):
+        '''Records the end of the run, so that every output reports the
+        same throughput'''
+        self.end_time = time.time()
+
+    def recipes_per_second(self):
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.time()
+        elapsed = end_time - self.start_time
+        if elapsed > 0:
+            return self.recipes / elapsed
+        return 0.0
+
+    def output_prometheus(self):
+        '''Returns the metrics in Prometheus text exposition format'''
+        def escape(value):
+            return encode_utf8(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+        lines = [
+            '# HELP recipe_checker_failures Failed tests by keypath '
+            'and test type.',
+            '# TYPE recipe_checker_failures gauge']
+        for key in sorted(self.failures):
+            lines.append(
+                'recipe_checker_failures{test_type="%s",keypath="%s",'
+                'severity="%i"} %i' % (escape(key[0]), escape(key[1]),
+                                       key[2], self.failures[key]))
+        lines.extend([
+            '# HELP recipe_checker_recipes Recipes tested in the run.',
+            '# TYPE recipe_checker_recipes gauge',
+            'recipe_checker_recipes %i' % self.recipes,
+            '# HELP recipe_checker_recipes_per_second Recipe throughput.',
+            '# TYPE recipe_checker_recipes_per_second gauge',
+            'recipe_checker_recipes_per_second %f' % (
+                self.recipes_per_second()),
+            '# HELP recipe_checker_phase_seconds Time spent in each phase.',
+            '# TYPE recipe_checker_phase_seconds gauge'])
+        for phase in sorted(self.phase_seconds):
+            lines.append('recipe_checker_phase_seconds{phase="%s"} %f' % (
+                phase, self.phase_seconds[phase]))
+        return '\n'.join(lines) + '\n'
+
+    def output_json(self):
+        '''Returns the metrics as a json summary'''
+        return json.dumps(
+            {
+                'recipes': self.recipes,
+                'recipes_per_second': self.recipes_per_second(),
+                'phase_seconds': self.phase_seconds,
+                'failures': [
+                    {'test_type': key[0],
+                     'keypath': key[1],
+                     'fail_severity': key[2],
+                     'count': self.failures[key]}
+                    for key in sorted(self.failures)]
+            },
+            sort_keys=True,
+            indent=4,
+            separators=(',', ': ')
+            )
+
+def write_metrics_file(metrics_file, contents):
+    '''Writes to a temporary file then renames, so that a collector
+    never reads a partially written file'''
+    tmp_file = metrics_file + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        outfile.write(contents)
+    os.rename(tmp_file, metrics_file)
+
+def recipe_cache_key(recipe_file):
+    '''Returns a key identifying the recipe content and the effective
+    test suite, or None if the file cannot be read. The extension is
+    included as recipe_has_correct_ext depends on it.'''
+    try:
+        with open(recipe_file, 'rb') as infile:
+            digest = hashlib.sha1(infile.read()).hexdigest()
+    except (IOError, OSError) as e:
+        return None
+    return (digest, recipe_type_from_file(recipe_file),
+            recipe_file.split('.')[-1])
+
+def resolve_test_suite(name, suites, resolved, seen=()):
+    '''Returns the test suite with the tests of its parent_suite chain
+    prepended, caching each compiled suite in resolved'''
+    if name in resolved:
+        return resolved[name]
+    suite = suites[name]
+    tests = []
+    parent = suite.get('parent_suite')
+    if parent:
+        if parent in seen or parent == name:
+            print 'Circular parent_suite \'%s\' in test suite \'%s\'' % (
+                parent, name)
+        elif parent not in suites:
+            print 'Unknown parent_suite \'%s\' in test suite \'%s\'' % (
+                parent, name)
+        else:
+            tests.extend(resolve_test_suite(
+                parent, suites, resolved, seen + (name,))['tests'])
+    for test in suite.get('tests', []):
+        if test not in tests:
+            tests.append(test)
+    resolved[name] = {'test_suite': name, 'tests': tests}
+    return resolved[name]
+
 def load_all_tests():
-    all_tests = {}
+    '''Loads all test suites, keyed by test_suite name'''
+    suites = {}
     for f in os.listdir(TESTS_FOLDER):
         try:
             with open (os.path.join(TESTS_FOLDER, f), 'r') as infile:
-                all_tests.update(plistlib.readPlist(infile))
+                suite = plistlib.readPlist(infile)
+                suites[suite['test_suite']] = suite
         except Exception as e:
             print e
-    return all_tests
+    resolved = {}
+    for name in suites:
+        resolve_test_suite(name, suites, resolved)
+    return resolved
 
 def main():
     parser = argparse.ArgumentParser()
@@ -273,16 +562,75 @@ def main():
     group.add_argument("--console", action="store_true")
     parser.add_argument("recipe", action='append', nargs='+', type=str,
                          help="at least one autopkg recipe file")
+    parser.add_argument("--baseline", type=str, metavar="FILE",
+                        help="report only failures that are new or resolved "
+                        "compared with FILE; FILE is created from this run "
+                        "if it does not exist")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="after comparing, rewrite the baseline FILE "
+                        "with the failures from this run")
+    parser.add_argument("--metrics", type=str, metavar="FILE",
+                        help="write run metrics to FILE in Prometheus "
+                        "textfile collector format")
+    parser.add_argument("--metrics-json", type=str, metavar="FILE",
+                        help="write a json summary of run metrics to FILE")
     args = parser.parse_args()
+    if args.update_baseline and not args.baseline:
+        parser.error("--update-baseline requires --baseline")
+    method = 'json' if args.json else 'console'
+
+    metrics = RunMetrics()
+    phase_start = time.time()
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        baseline = load_baseline(args.baseline)
+    fingerprints = {}
+    tested_paths = set()
+    test_suites = load_all_tests()
+    metrics.add_phase_time('load', time.time() - phase_start)
+    evaluated = {}
 
     for recipe in args.recipe[0]:
-        rt = RecipeTester(recipe, load_all_tests())
+        phase_start = time.time()
+        cache_key = recipe_cache_key(recipe)
+        if cache_key in evaluated:
+            rt = evaluated[cache_key].copy_for_file(recipe)
+            metrics.add_phase_time('load', time.time() - phase_start)
+        else:
+            rt = RecipeTester(recipe, test_suites)
+            metrics.add_phase_time('load', time.time() - phase_start)
+
+            phase_start = time.time()
+            rt.run_tests()
+            metrics.add_phase_time('test', time.time() - phase_start)
+            if cache_key is not None:
+                evaluated[cache_key] = rt
+        metrics.add_results(rt.results)
+
+        phase_start = time.time()
+        path = decode_utf8(rt.recipe_file)
+        tested_paths.add(path)
+        for fingerprint in rt.failure_fingerprints():
+            fingerprints.setdefault(fingerprint, set()).add(path)
+        output = rt.output_test_results(method, baseline)
+        if output is not None:
+            print output
+        metrics.add_phase_time('emit', time.time() - phase_start)
+
+    if baseline is not None:
+        resolved = resolved_failures(baseline, fingerprints, tested_paths)
+        print output_resolved_failures(method, resolved)
+        if args.update_baseline:
+            write_baseline(args.baseline, merge_baseline(
+                baseline, fingerprints, tested_paths))
+    elif args.baseline:
+        write_baseline(args.baseline, fingerprints)
 
-        rt.run_tests()
-        if args.json:
-            print rt.output_test_results('json')
-        elif args.console:
-            print rt.output_test_results('console')
+    metrics.finish()
+    if args.metrics:
+        write_metrics_file(args.metrics, metrics.output_prometheus())
+    if args.metrics_json:
+        write_metrics_file(args.metrics_json, metrics.output_json())
 
 if __name__ == '__main__':
     main()